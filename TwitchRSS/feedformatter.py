@@ -29,6 +29,7 @@
 __version__ = "0.4"
 
 from io import StringIO
+import json
 
 # This "staircase" of import attempts is ugly.  If there's a nicer way to do
 # this, please let me know!
@@ -53,7 +54,7 @@ try:
 except ImportError:
     feedformatterCanPrettyPrint = False
 
-from time import time, strftime, localtime, mktime, struct_time, timezone
+from time import time, strftime, gmtime, mktime, struct_time
 
 # RSS 1.0 Functions ----------
 
@@ -100,38 +101,44 @@ _rss2_item_mappings = (
 
 _atom_feed_mappings = (
     (("title",), "title"),
-    (("link", "url"), "id"),
+    (("id", "link", "url"), "id"),
+    (("link", "url"), "link", lambda x: _atomise_link(x)),
+    (("feed_url",), "link", lambda x: {"rel" : "self", "href" : x}),
     (("description", "desc", "summary"), "subtitle"),
-    (("pubDate", "pubdate", "date", "published", "updated"), "pubDate", lambda x: _format_datetime("atom",x)),
-    (("category",), "category"),
+    (("pubDate", "pubdate", "date", "published", "updated"), "updated", lambda x: _format_datetime("atom",x)),
+    (("category",), "category", lambda x: _atomise_category(x)),
     (("author",), "author", lambda x: _atomise_author(x))
 )
 
 _atom_item_mappings = (
     (("title",), "title"),
-    (("link", "url"), "id"),
+    (("id", "guid", "link", "url"), "id"),
     (("link", "url"), "link", lambda x: _atomise_link(x)),
     (("description", "desc", "summary"), "summary"),
-    (("pubDate", "pubdate", "date", "published", "updated"), "pubDate", lambda x: _format_datetime("atom",x)),
-    (("category",), "category"),
+    (("pubDate", "pubdate", "date", "published", "updated"), "updated", lambda x: _format_datetime("atom",x)),
+    (("category",), "category", lambda x: _atomise_category(x)),
     (("author",), "author", lambda x: _atomise_author(x))
 )
 
-def _get_tz_offset():
+# JSON Feed 1.1 ----------
 
-    """
-    Return the current timezone's offset from GMT as a string
-    in the format +/-HH:MM, as required by RFC3339.
-    """
+_json_feed_mappings = (
+    (("title",), "title"),
+    (("link", "url"), "home_page_url"),
+    (("feed_url",), "feed_url"),
+    (("description", "desc", "summary"), "description"),
+    (("author",), "authors", lambda x: _jsonify_author(x))
+)
 
-    seconds = -1*timezone    # Python gets the offset backward! >:(
-    minutes = seconds/60
-    hours = minutes/60
-    minutes = minutes - hours*60
-    if seconds < 0:
-        return "-%02d:%d" % (hours, minutes)
-    else:
-        return "+%02d:%d" % (hours, minutes)
+_json_item_mappings = (
+    (("id", "guid"), "id"),
+    (("link", "url"), "url"),
+    (("title",), "title"),
+    (("description", "desc", "summary"), "content_html"),
+    (("pubDate", "pubdate", "date", "published", "updated"), "date_published", lambda x: _format_datetime("atom",x)),
+    (("category",), "tags", lambda x: [x]),
+    (("author",), "authors", lambda x: _jsonify_author(x))
+)
 
 def _convert_datetime(time):
 
@@ -145,7 +152,7 @@ def _convert_datetime(time):
         return time
     elif type(time) is int or type(time) is float:
         # Assume this is a seconds-since-epoch time
-        return localtime(time)
+        return gmtime(time)
     elif type(time) is str:
         if time.isalnum():
             # String is alphanumeric - a time stamp?
@@ -156,7 +163,7 @@ def _convert_datetime(time):
         else:
             # Maybe this is a string of an epoch time?
             try:
-                return localtime(float(time))
+                return gmtime(float(time))
             except ValueError:
                 # Guess not.
                 raise Exception("Unrecongised time format!")
@@ -176,18 +183,26 @@ def _format_datetime(feed_type, time):
     time = _convert_datetime(time)
 
     # Then, convert that to the appropriate string
-    if feed_type is "rss2":
+    # Times are taken to be in UTC, as for RSS 2.0
+    if feed_type == "rss2":
         return strftime("%a, %d %b %Y %H:%M:%S UT", time)
-    elif feed_type is "atom":
-        return strftime("%Y-%m-%dT%H:%M:%S", time) + _get_tz_offset();
+    elif feed_type == "atom":
+        return strftime("%Y-%m-%dT%H:%M:%SZ", time)
 
 def _atomise_link(link):
 
     if type(link) is dict:
-        return dict
+        return link
     else:
         return {"href" : link}
 
+def _atomise_category(category):
+
+    if type(category) is dict:
+        return category
+    else:
+        return {"term" : category}
+
 def _atomise_author(author):
 
     """
@@ -227,6 +242,40 @@ def _rssify_author(author):
         else:
             return None
 
+def _jsonify_author(author):
+
+    """
+    Convert author from whatever it is to a list holding a JSON Feed
+    author object, or None if there is nothing JSON Feed can represent.
+    """
+
+    author = _atomise_author(author)
+    result = {}
+    if "name" in author:
+        result["name"] = author["name"]
+    if "uri" in author:
+        result["url"] = author["uri"]
+    if not result:
+        return None
+    return [result]
+
+def _add_members(root_object, mappings, dictionary):
+
+    """
+    Add one member to the JSON object root_object for each key in
+    dictionary which is supported by a mapping in mappings
+    """
+    for mapping in mappings:
+        for key in mapping[0]:
+            if key in dictionary:
+                if len(mapping) == 2:
+                    value = dictionary[key]
+                elif len(mapping) == 3:
+                    value = mapping[2](dictionary[key])
+                if value is not None:
+                    root_object[mapping[1]] = value
+                break
+
 def _add_subelems(root_element, mappings, dictionary):
 
     """
@@ -250,8 +299,8 @@ def _add_subelem(root_element, name, value):
 
     if type(value) is dict:
         ### HORRIBLE HACK!
-        if name=="link":
-            ET.SubElement(root_element, name, href=value["href"])
+        if name in ("link", "category"):
+            ET.SubElement(root_element, name, value)
         else:
             subElem = ET.SubElement(root_element, name)
             for key in value:
@@ -261,6 +310,9 @@ def _add_subelem(root_element, name, value):
             el = ET.SubElement(root_element, name)
             el.text = value
             el.attrib["isPermaLink"] = "false"
+        elif name == "summary":
+            # Descriptions are HTML
+            ET.SubElement(root_element, name, type="html").text = value
         else:
             ET.SubElement(root_element, name).text = value
 
@@ -446,6 +498,49 @@ class Feed:
         fp.write(string)
         fp.close()
 
+    ### JSON FEED STUFF ------------------------------
+
+    def validate_json(self):
+
+        """Raise an InvalidFeedException if the feed cannot be validly
+        formatted as JSON Feed 1.1."""
+
+        # The feed must contain "title"
+        if "title" not in self.feed:
+            raise InvalidFeedException("A JSON Feed must contain a title")
+
+        # Each item must contain "id"
+        for item in self.items:
+            if not ("guid" in item or "id" in item):
+                raise InvalidFeedException("Each item in a JSON Feed "
+                "must contain an id")
+
+    def format_json_string(self, validate=True, pretty=False):
+
+        """Format the feed as JSON Feed 1.1 and return the result as a
+        UTF-8 encoded string."""
+
+        if validate:
+            self.validate_json()
+        JSONroot = {"version" : "https://jsonfeed.org/version/1.1"}
+        _add_members(JSONroot, _json_feed_mappings, self.feed)
+        JSONroot["items"] = []
+        for item in self.items:
+            JSONitem = {}
+            _add_members(JSONitem, _json_item_mappings, item)
+            JSONroot["items"].append(JSONitem)
+        return json.dumps(JSONroot, ensure_ascii=False,
+            indent=4 if pretty else None).encode("utf-8")
+
+    def format_json_file(self, filename, validate=True, pretty=False):
+
+        """Format the feed as JSON Feed 1.1 and save the result to a file."""
+
+        string = self.format_json_string(validate, pretty)
+        fp = open(filename, "wb")
+        fp.write(string)
+        fp.close()
+
 class InvalidFeedException(Exception):
 
     pass
@@ -477,6 +572,8 @@ def main():
     print(feed.format_rss2_string(pretty=True))
     print("---- Atom 1.0 ----")
     print(feed.format_atom_string(pretty=True))
+    print("---- JSON Feed 1.1 ----")
+    print(feed.format_json_string(pretty=True).decode("utf-8"))
 
 if __name__ == "__main__":
     main()
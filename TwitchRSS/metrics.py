@@ -0,0 +1,217 @@
+#
+# Copyright 2020 Laszlo Zeke
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+# Minimal Prometheus text format instrumentation. Recording a sample is a dict
+# update under a lock; all formatting happens when /metrics is scraped.
+
+from bisect import bisect_left
+from cachetools import Cache, TTLCache
+import threading
+
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+DEFAULT_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1.0, 2.5, 5.0, 10.0)
+_MISSING = object()
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, int):
+        return str(value)
+    return repr(float(value))
+
+
+def _format_labels(names, values):
+    if not names:
+        return ''
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+        pairs.append('%s="%s"' % (name, value))
+    return '{%s}' % ','.join(pairs)
+
+
+class Metric:
+    type = 'untyped'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def samples(self):
+        return []
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.documentation),
+                 '# TYPE %s %s' % (self.name, self.type)]
+        for name, labelnames, labelvalues, value in self.samples():
+            lines.append('%s%s %s' % (name, _format_labels(labelnames, labelvalues), _format_value(value)))
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, *labelvalues, amount=1):
+        with self._lock:
+            self._values[labelvalues] = self._values.get(labelvalues, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        return [(self.name, self.labelnames, labels, value) for labels, value in values]
+
+
+class GaugeFunction(Metric):
+    """A gauge whose values are read from callback at scrape time.
+
+    callback returns an iterable of (labelvalues, value) pairs."""
+
+    type = 'gauge'
+
+    def __init__(self, name, documentation, labelnames, callback):
+        Metric.__init__(self, name, documentation, labelnames)
+        self.callback = callback
+
+    def samples(self):
+        return [(self.name, self.labelnames, labels, value) for labels, value in self.callback()]
+
+
+class CounterFunction(GaugeFunction):
+    """Like GaugeFunction, for monotonic values counted elsewhere."""
+
+    type = 'counter'
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        Metric.__init__(self, name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, *labelvalues):
+        # Bucket counts are kept per bucket and only accumulated when rendered.
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(labelvalues)
+            if state is None:
+                state = self._values[labelvalues] = [[0] * (len(self.buckets) + 1), 0.0]
+            state[0][index] += 1
+            state[1] += value
+
+    def samples(self):
+        with self._lock:
+            values = sorted((labels, (list(counts), total)) for labels, (counts, total) in self._values.items())
+        bucket_labelnames = self.labelnames + ('le',)
+        result = []
+        for labels, (counts, total) in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                result.append((self.name + '_bucket', bucket_labelnames, labels + (_format_value(bound),), cumulative))
+            result.append((self.name + '_sum', self.labelnames, labels, total))
+            result.append((self.name + '_count', self.labelnames, labels, cumulative))
+        return result
+
+
+class Registry:
+
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        return '\n'.join(metric.render() for metric in self.metrics) + '\n'
+
+
+class MeteredTTLCache(TTLCache):
+    """TTLCache counting hits, misses and evictions for the cached decorator.
+
+    Counters are plain attribute increments so lookups stay as cheap as in
+    TTLCache; they are read by cache_metrics when scraped."""
+
+    def __init__(self, name, maxsize, ttl, **kwargs):
+        TTLCache.__init__(self, maxsize, ttl, **kwargs)
+        self.name = name
+        self.bytes_sized = kwargs.get('getsizeof') is not None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def __getitem__(self, key):
+        value = TTLCache.__getitem__(self, key)
+        self.hits += 1
+        return value
+
+    def __missing__(self, key):
+        self.misses += 1
+        raise KeyError(key)
+
+    def pop(self, key, default=_MISSING):
+        # Removing an entry is not a lookup, so read it without counting a hit
+        with self.timer:
+            if key in self:
+                value = TTLCache.__getitem__(self, key)
+                del self[key]
+                return value
+        if default is _MISSING:
+            raise KeyError(key)
+        return default
+
+    def popitem(self):
+        item = TTLCache.popitem(self)
+        self.evictions += 1
+        return item
+
+    def expire(self, time=None):
+        size = Cache.__len__(self)
+        TTLCache.expire(self, time)
+        self.expirations += size - Cache.__len__(self)
+
+
+def cache_metrics(registry, prefix, caches):
+    """Register scrape time hit, miss, eviction and size metrics for caches."""
+
+    def collect(read, bytes_sized=None):
+        return lambda: [((cache.name,), read(cache)) for cache in caches
+                        if bytes_sized is None or cache.bytes_sized == bytes_sized]
+
+    registry.register(CounterFunction(prefix + '_cache_hits_total', 'Cache lookups answered from the cache.',
+                                      ('cache',), collect(lambda c: c.hits)))
+    registry.register(CounterFunction(prefix + '_cache_misses_total', 'Cache lookups that went upstream.',
+                                      ('cache',), collect(lambda c: c.misses)))
+    registry.register(CounterFunction(prefix + '_cache_evictions_total', 'Cache entries removed by size pressure or TTL expiry.',
+                                      ('cache', 'reason'),
+                                      lambda: [((c.name, reason), value) for c in caches
+                                               for reason, value in (('size', c.evictions),
+                                                                     ('expired', c.expirations))]))
+    registry.register(GaugeFunction(prefix + '_cache_size', 'Current number of entries in the cache.',
+                                    ('cache',), collect(lambda c: c.currsize, False)))
+    registry.register(GaugeFunction(prefix + '_cache_maxsize', 'Maximum number of entries in the cache.',
+                                    ('cache',), collect(lambda c: c.maxsize, False)))
+    registry.register(GaugeFunction(prefix + '_cache_size_bytes', 'Current size of a byte sized cache.',
+                                    ('cache',), collect(lambda c: c.currsize, True)))
+    registry.register(GaugeFunction(prefix + '_cache_maxsize_bytes', 'Maximum size of a byte sized cache.',
+                                    ('cache',), collect(lambda c: c.maxsize, True)))
@@ -0,0 +1,107 @@
+#
+# Copyright 2020 Laszlo Zeke
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+from contextlib import contextmanager
+from os import getpid, makedirs, path
+import cProfile
+import itertools
+import logging
+import pstats
+import threading
+import time
+
+
+class StageTimer:
+    """Wall clock time spent in the named stages of a single request.
+
+    A stage entered more than once accumulates its durations. Time spent in a
+    stage nested inside another is only counted for the inner one, so the
+    stages never overlap. histogram, if given, observes the full duration."""
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.stages = {}
+        self._nested = []
+
+    @contextmanager
+    def stage(self, name, histogram=None, *labelvalues):
+        start = time.perf_counter()
+        self._nested.append(0.0)
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            inner = self._nested.pop()
+            self.stages[name] = self.stages.get(name, 0.0) + elapsed - inner
+            if self._nested:
+                self._nested[-1] += elapsed
+            if histogram is not None:
+                histogram.observe(elapsed, *labelvalues)
+
+    def total(self):
+        return time.perf_counter() - self.start
+
+    def breakdown(self):
+        return ', '.join('%s=%.1fms' % (name, seconds * 1000) for name, seconds in self.stages.items())
+
+    def server_timing(self):
+        entries = ['%s;dur=%.1f' % (name, seconds * 1000) for name, seconds in self.stages.items()]
+        entries.append('total;dur=%.1f' % (self.total() * 1000))
+        return ', '.join(entries)
+
+
+class SamplingProfiler:
+    """Profile one in every `every` requests and keep the results aggregated.
+
+    After each sampled request the aggregate is written to
+    directory/twitchrss-<pid>.prof, readable with pstats or snakeviz.
+    Only one request is profiled at a time; a sample landing while another
+    is running is skipped."""
+
+    def __init__(self, every, directory):
+        self.every = every
+        self.directory = directory
+        self.stats = None
+        self._counter = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def start(self):
+        """Return an enabled profiler if this request is sampled, else None."""
+        if next(self._counter) % self.every or not self._lock.acquire(blocking=False):
+            return None
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError as e:
+            # Another profiling tool is already active
+            logging.warning("Could not start profiler: %s" % e)
+            self._lock.release()
+            return None
+        return profiler
+
+    def stop(self, profiler):
+        profiler.disable()
+        try:
+            if self.stats is None:
+                self.stats = pstats.Stats(profiler)
+            else:
+                self.stats.add(profiler)
+            makedirs(self.directory, exist_ok=True)
+            self.stats.dump_stats(path.join(self.directory, 'twitchrss-%d.prof' % getpid()))
+        except Exception as e:
+            logging.warning("Could not dump profile: %s" % e)
+        finally:
+            self._lock.release()
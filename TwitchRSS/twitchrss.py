@@ -14,29 +14,49 @@
 # limitations under the License.
 #
 
-from cachetools import cached, TTLCache, LRUCache
+from cachetools import cached, LRUCache
+from cachetools.keys import hashkey
 from feedformatter import Feed
-from flask import abort, Flask, request
+from metrics import cache_metrics, Counter, Histogram, MeteredTTLCache, Registry, CONTENT_TYPE as METRICS_CONTENT_TYPE
+from flask import abort, Flask, g, request, url_for
+from timing import SamplingProfiler, StageTimer
 from io import BytesIO
 from os import environ
 import datetime
 import gzip
+import hmac
+import itertools
 import time
 import json
 import logging
 import re
 import urllib
+import urllib.error
 
 
 VOD_URL_TEMPLATE = 'https://api.twitch.tv/helix/videos?user_id=%s&type=%s'
 USERID_URL_TEMPLATE = 'https://api.twitch.tv/helix/users?login=%s'
 AUTH_URL = 'https://id.twitch.tv/oauth2/token'
 VODCACHE_LIFETIME = 10 * 60
+RENDERCACHE_SIZE = 16 * 1024 * 1024
 USERIDCACHE_LIFETIME = 24 * 60 * 60
 CHANNEL_FILTER = re.compile("^[a-zA-Z0-9_]{2,25}$")
 TWITCH_CLIENT_ID = environ.get("TWITCH_CLIENT_ID")
 TWITCH_CLIENT_SECRET = environ.get("TWITCH_CLIENT_SECRET")
+ATOM_TAG_PREFIX = 'tag:twitchrss.appspot.com,2020'  # RFC 4151 tag URIs for Atom and JSON Feed ids
 VALID_URL_ARGS = ('all', 'archive', 'highlight', 'live') #all is everything, archive is past broadcasts, highlight is stream highlight.
+SERVER_TIMING = environ.get('SERVER_TIMING', '').lower() in ('1', 'true', 'yes', 'on')
+SLOW_REQUEST_MS = float(environ.get('SLOW_REQUEST_MS', 2000))
+PROFILE_EVERY = int(environ.get('PROFILE_EVERY', 0))
+PROFILE_DIR = environ.get('PROFILE_DIR', '/tmp/twitchrss-profiles')
+FEED_ENDPOINTS = ('vod', 'vodonly')
+METRICS_TOKEN = environ.get('METRICS_TOKEN')
+FEED_BASE_URL = environ.get('FEED_BASE_URL', 'https://twitchrss.appspot.com').rstrip('/')
+FEED_FORMATS = {
+    'rss': ('application/rss+xml', Feed.format_rss2_string),
+    'atom': ('application/atom+xml', Feed.format_atom_string),
+    'json': ('application/feed+json', Feed.format_json_string),
+}
 
 logging.basicConfig(level=logging.DEBUG if environ.get('DEBUG') else logging.INFO)
 
@@ -45,8 +65,81 @@ if not TWITCH_CLIENT_ID:
 if not TWITCH_CLIENT_SECRET:
     raise Exception("Twitch API secret env variable not set.")
 
+UPSTREAM_ENDPOINTS = {VOD_URL_TEMPLATE: 'videos', USERID_URL_TEMPLATE: 'users'}
+
 oauth = {'token': '', 'epoch': 0}
 app = Flask(__name__, static_folder='')
+profiler = SamplingProfiler(PROFILE_EVERY, PROFILE_DIR) if PROFILE_EVERY > 0 else None
+
+user_cache = MeteredTTLCache('user', maxsize=5000, ttl=USERIDCACHE_LIFETIME)
+vod_cache = MeteredTTLCache('vod', maxsize=1000, ttl=VODCACHE_LIFETIME)
+# Rendered feeds, bounded by total bytes
+render_cache = MeteredTTLCache('render', maxsize=RENDERCACHE_SIZE, ttl=VODCACHE_LIFETIME, getsizeof=len)
+feed_generations = itertools.count()
+
+registry = Registry()
+cache_metrics(registry, 'twitchrss', (user_cache, vod_cache, render_cache))
+upstream_seconds = registry.register(Histogram(
+    'twitchrss_upstream_request_duration_seconds', 'Duration of Twitch API calls.', ('endpoint', 'status')))
+upstream_retries = registry.register(Counter(
+    'twitchrss_upstream_retries_total', 'Twitch API attempts retried after a failure.', ('endpoint',)))
+upstream_unavailable = registry.register(Counter(
+    'twitchrss_upstream_unavailable_total', 'Requests answered with 503 after exhausting retries.', ('endpoint',)))
+oauth_refreshes = registry.register(Counter(
+    'twitchrss_oauth_refresh_total', 'OAuth token refresh attempts.', ('result',)))
+render_seconds = registry.register(Histogram(
+    'twitchrss_render_duration_seconds', 'Duration of feed rendering.', ('format',)))
+compress_seconds = registry.register(Histogram(
+    'twitchrss_compress_duration_seconds', 'Duration of gzip compression of feeds.', ('format',)))
+
+
+def fetch_url(request, endpoint):
+    # urlopen and read the body, recording how long the round trip took
+    start = time.perf_counter()
+    status = 'error'
+    try:
+        result = urllib.request.urlopen(request, timeout=3)
+        status = str(result.getcode())
+        return result, result.read()
+    except urllib.error.HTTPError as e:
+        status = str(e.code)
+        raise
+    finally:
+        upstream_seconds.observe(time.perf_counter() - start, endpoint, status)
+
+
+def stage(name, histogram=None, *labelvalues):
+    return g.timer.stage(name, histogram, *labelvalues)
+
+
+@app.before_request
+def start_request():
+    g.timer = StageTimer()
+    g.profile = None
+    if profiler and request.endpoint in FEED_ENDPOINTS:
+        g.profile = profiler.start()
+
+
+@app.after_request
+def add_server_timing(response):
+    if SERVER_TIMING:
+        response.headers['Server-Timing'] = g.timer.server_timing()
+    return response
+
+
+@app.teardown_request
+def finish_request(exception):
+    # Runs for failed requests too, unlike after_request
+    timer = g.get('timer')
+    if timer:
+        elapsed_ms = timer.total() * 1000
+        if elapsed_ms > SLOW_REQUEST_MS:
+            logging.warning("Slow request %s took %.1fms: %s" % (request.path, elapsed_ms, timer.breakdown()))
+    # Stopped after the slow check so dumping the profile is not counted
+    if g.get('profile'):
+        profiler.stop(g.profile)
+        g.profile = None
+
 
 def authorize():
     # return if token has not expired
@@ -63,15 +156,20 @@ def authorize():
     retries = 0
     while retries < 3:
         try:
-            result = urllib.request.urlopen(request, timeout=3)
-            r = json.loads(result.read().decode("utf-8"))
+            result, body = fetch_url(request, 'oauth')
+            r = json.loads(body.decode("utf-8"))
             oauth['token'] = r['access_token']
             oauth['epoch'] = int(r['expires_in']) + round(time.time()) - 1
             logging.debug("oauth token aquired")
+            oauth_refreshes.inc('success')
             return oauth['token']
         except Exception as e:
             logging.warning("Fetch exception caught: %s" % e)
             retries += 1
+            if retries < 3:
+                upstream_retries.inc('oauth')
+    oauth_refreshes.inc('failure')
+    upstream_unavailable.inc('oauth')
     abort(503)
 
 
@@ -84,6 +182,18 @@ def index():
 def favicon():
     return app.send_static_file('favicon.ico')
 
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    # Disabled unless a token is configured; scrapers send it as a bearer token
+    if not METRICS_TOKEN:
+        abort(404)
+    # Compared as bytes, compare_digest rejects non-ASCII str; headers arrive as latin-1
+    authorization = request.headers.get('Authorization', '').encode('latin-1')
+    if not hmac.compare_digest(authorization, ('Bearer ' + METRICS_TOKEN).encode('utf-8')):
+        abort(403)
+    return registry.render(), {'Content-Type': METRICS_CONTENT_TYPE}
+
+
 @app.route('/vod/<string:channel>', methods=['GET', 'HEAD'])
 def vod(channel):
     if CHANNEL_FILTER.match(channel):
@@ -101,47 +211,109 @@ def vodonly(channel):
 
 
 def get_inner(channel, add_live=True):
-    userid_json = fetch_user(channel)
+    with stage('fetch_user'):
+        userid_json = fetch_user(channel)
     if not userid_json:
         abort(404)
 
     (channel_display_name, channel_id) = extract_userid(userid_json)
-    logging.debug("Start fetching vods")
     clip_filter = request.args.get('filter')
-    channel_json = fetch_vods(channel_id, clip_filter)
-    if not channel_json:
-        abort(404)
-    logging.debug("Finish fetching vods")
-    decoded_json = json.loads(channel_json)['data']
-    rss_data = construct_rss(channel, decoded_json, channel_display_name, add_live)
-    headers = {'Content-Type': 'application/rss+xml'}
-
-    if 'gzip' in request.headers.get("Accept-Encoding", ''):
+    if clip_filter not in VALID_URL_ARGS:
+        clip_filter = 'all'
+    feed_format = request.args.get('format')
+    if feed_format not in FEED_FORMATS:
+        feed_format = 'rss'
+    generation, feed = fetch_feed(channel, channel_id, channel_display_name, clip_filter)
+    headers = {'Content-Type': FEED_FORMATS[feed_format][0]}
+
+    compress = 'gzip' in request.headers.get("Accept-Encoding", '')
+    if compress:
         headers['Content-Encoding'] = 'gzip'
-        rss_data = gzip.compress(rss_data)
 
-    return rss_data, headers
+    args = {}
+    if clip_filter != 'all':
+        args['filter'] = clip_filter
+    if feed_format != 'rss':
+        args['format'] = feed_format
+    # Built from the configured base URL rather than the request, as the
+    # rendered output is shared by clients on any host or scheme
+    feed_url = FEED_BASE_URL + url_for(request.endpoint, channel=channel.lower(), **args)
+
+    return render_feed(generation, feed, feed_url, feed_format, add_live, compress), headers
 
 
-@cached(cache=TTLCache(maxsize=5000, ttl=USERIDCACHE_LIFETIME))
+def render_feed(generation, feed, feed_url, feed_format, add_live, compress):
+    # Keyed on the generation of the cached feed, so a refetched feed never
+    # serves output rendered from its predecessor
+    key = (generation, feed_format, add_live, compress)
+    try:
+        return render_cache[key]
+    except KeyError:
+        pass
+
+    if compress:
+        data = render_feed(generation, feed, feed_url, feed_format, add_live, False)
+        with stage('gzip', compress_seconds, feed_format):
+            data = gzip.compress(data)
+    else:
+        items = feed.items
+        if not add_live:
+            items = [item for item in items if item["category"] != "live"]
+        feed = Feed(feed_properties(feed, feed_format, feed_url), items)
+        with stage('render', render_seconds, feed_format):
+            data = FEED_FORMATS[feed_format][1](feed)
+    try:
+        render_cache[key] = data
+    except ValueError:
+        pass  # larger than the whole cache
+    return data
+
+
+@cached(cache=user_cache)
 def fetch_user(channel_name):
     return fetch_json(channel_name, USERID_URL_TEMPLATE)
 
 
-@cached(cache=TTLCache(maxsize=1000, ttl=VODCACHE_LIFETIME))
-def fetch_vods(channel_id, clip_filter):
-    
-    if clip_filter not in VALID_URL_ARGS:
-        clip_filter = 'all'
-    if clip_filter is None:
-        clip_filter = 'all'
+def feed_properties(feed, feed_format, feed_url):
+    # RSS keeps its long standing channel properties, Atom and JSON Feed
+    # describe the Twitch channel itself
+    if feed_format == 'rss':
+        return feed.feed
+    return dict(feed.feed,
+                title="%s's Twitch video feed" % feed.feed["display_name"],
+                description="The feed of %s's videos on Twitch" % feed.feed["display_name"],
+                link="https://www.twitch.tv/%s" % feed.feed["login"],
+                feed_url=feed_url)
+
+
+def feed_key(channel_name, channel_id, display_name, clip_filter):
+    # The name arguments follow from channel_id, so /vod/foo and /vod/Foo share an entry
+    return hashkey(channel_id, clip_filter)
 
+
+@cached(cache=vod_cache, key=feed_key)
+def fetch_feed(channel_name, channel_id, display_name, clip_filter):
+    logging.debug("Start fetching vods")
+    with stage('fetch_vods'):
+        channel_json = fetch_vods(channel_id, clip_filter)
+    if not channel_json:
+        abort(404)
+    logging.debug("Finish fetching vods")
+    with stage('json_loads'):
+        decoded_json = json.loads(channel_json)['data']
+    with stage('construct_feed'):
+        feed = construct_feed(channel_name, channel_id, decoded_json, display_name)
+    return next(feed_generations), feed
+
+
+def fetch_vods(channel_id, clip_filter):
     return fetch_json(channel_id, VOD_URL_TEMPLATE, clip_filter)
 
 
 def fetch_json(id, url_template, clip_filter = None):
     #update the oauth token
-    token = authorize()
+    with stage('authorize'):
+        token = authorize()
     if clip_filter:
         url = url_template % (id, clip_filter)
     else:
@@ -153,19 +325,23 @@ def fetch_json(id, url_template, clip_filter = None):
         'Client-Id': TWITCH_CLIENT_ID,
         'Accept-Encoding': 'gzip'
     }
+    endpoint = UPSTREAM_ENDPOINTS[url_template]
     request = urllib.request.Request(url, headers=headers)
     retries = 0
     while retries < 3:
         try:
-            result = urllib.request.urlopen(request, timeout=3)
+            result, body = fetch_url(request, endpoint)
             logging.debug('Fetch from twitch for %s with code %s' % (id, result.getcode()))
             if result.info().get('Content-Encoding') == 'gzip':
                 logging.debug('Fetched gzip content')
-                return gzip.decompress(result.read())
-            return result.read()
+                return gzip.decompress(body)
+            return body
         except Exception as e:
             logging.warning("Fetch exception caught: %s" % e)
             retries += 1
+            if retries < 3:
+                upstream_retries.inc(endpoint)
+    upstream_unavailable.inc(endpoint)
     abort(503)
 
 
@@ -179,8 +355,9 @@ def extract_userid(user_info):
         abort(404)
 
 
-def construct_rss(channel_name, vods_info, display_name, add_live=True):
+def construct_feed(channel_name, channel_id, vods_info, display_name):
     feed = Feed()
+    channel_name = channel_name.lower()
 
     # Set the feed/channel level properties
     feed.feed["title"] = "%s's Twitch video RSS" % display_name
@@ -188,6 +365,10 @@ def construct_rss(channel_name, vods_info, display_name, add_live=True):
     feed.feed["author"] = "Twitch RSS Generated"
     feed.feed["description"] = "The RSS Feed of %s's videos on Twitch" % display_name
     feed.feed["ttl"] = '10'
+    # Not mapped by any format, used by feed_properties and for Atom ids
+    feed.feed["id"] = "%s:channel/%s" % (ATOM_TAG_PREFIX, channel_id)
+    feed.feed["login"] = channel_name
+    feed.feed["display_name"] = display_name
 
     # Create an item
     try:
@@ -198,8 +379,6 @@ def construct_rss(channel_name, vods_info, display_name, add_live=True):
                 # It seems if the thumbnail is empty then we are live?
                 # Tempted to go in and fix it for them since the source is leaked..
                 if vod["thumbnail_url"] == "https://vod-secure.twitch.tv/_404/404_processing_%{width}x%{height}.png":
-                    if not add_live:
-                        continue
                     link = "https://www.twitch.tv/%s" % channel_name
                     item["title"] = "%s - LIVE" % vod['title']
                     item["category"] = "live"
@@ -218,12 +397,19 @@ def construct_rss(channel_name, vods_info, display_name, add_live=True):
                 item["guid"] = vod['id']
                 if item["category"] == "live":  # To show a different news item when recording is over
                     item["guid"] += "_live"
+                item["id"] = "%s:video/%s" % (ATOM_TAG_PREFIX, item["guid"])
                 feed.items.append(item)
     except KeyError as e:
         logging.warning('Issue with json: %s\nException: %s' % (vods_info, e))
         abort(404)
 
-    return feed.format_rss2_string()
+    # Atom requires a feed level update time
+    if feed.items:
+        feed.feed["pubDate"] = max(item["pubDate"] for item in feed.items)
+    else:
+        feed.feed["pubDate"] = time.gmtime()
+
+    return feed
 
 
 # For debug